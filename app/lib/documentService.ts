@@ -14,6 +14,20 @@ export interface Document {
   uploadedBy: string;
 }
 
+export interface DocumentChange {
+  op: 'add' | 'delete';
+  id: string;
+  document?: Document;
+}
+
+/**
+ * Response from the change feed: either deltas since the cursor, or a full
+ * snapshot when no cursor was given or it is too old to replay
+ */
+export type DocumentChangesResponse =
+  | { cursor: string; snapshot: false; changes: DocumentChange[] }
+  | { cursor: string; snapshot: true; documents: Document[] };
+
 export const documentService = {
   /**
    * Get all documents from the server
@@ -104,6 +118,35 @@ export const documentService = {
     }
   },
 
+  /**
+   * Get document changes since a cursor returned by a previous call.
+   * With `wait` (seconds, max 30) the server holds the request until something changes.
+   */
+  getDocumentChanges: async (since?: string, wait?: number): Promise<DocumentChangesResponse> => {
+    try {
+      const params = new URLSearchParams();
+      if (since) params.set('since', since);
+      if (wait) params.set('wait', String(wait));
+
+      const response = await fetch(`${DOCUMENT_SERVER_URL}/documents/changes?${params.toString()}`, {
+        method: 'GET',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.error || `Failed to fetch document changes: ${response.status}`);
+      }
+
+      return await response.json();
+    } catch (error) {
+      console.error('Error fetching document changes:', error);
+      throw error;
+    }
+  },
+
   /**
    * Search for documents on the server
    */
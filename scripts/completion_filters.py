@@ -0,0 +1,88 @@
+"""
+Filters applied to streamed completions by the LLM server: stop sequences and
+detection of degenerate repetition loops
+"""
+
+class StopSequenceFilter:
+    """Incrementally scans streamed text for stop sequences, even when one is split across chunks.
+
+    Text that could still turn out to be the start of a stop sequence is held
+    back until the next chunk settles it. Turn markers are stop sequences that
+    only apply once the reply has some non-whitespace text, so a model that
+    opens with its own role label (e.g. "Baun:") isn't cut off before answering.
+    """
+    def __init__(self, stop_sequences, turn_markers=()):
+        self.stop_sequences = list(dict.fromkeys(stop_sequences))
+        self.turn_markers = [marker for marker in dict.fromkeys(turn_markers) if marker not in self.stop_sequences]
+        self.stopped = False
+        self._pending = ""
+        self._has_output = False
+
+    def feed(self, text):
+        """Add a chunk of output and return the part of it that is safe to emit"""
+        if self.stopped:
+            return ""
+        self._pending += text
+        
+        matches = [i for i in (self._pending.find(stop) for stop in self.stop_sequences) if i != -1]
+        if self.turn_markers:
+            # A turn marker only counts once there is reply text before it
+            if self._has_output:
+                start = 0
+            else:
+                stripped = self._pending.lstrip()
+                start = len(self._pending) - len(stripped) + 1 if stripped else None
+            if start is not None:
+                matches += [i for i in (self._pending.find(marker, start) for marker in self.turn_markers) if i != -1]
+        if matches:
+            output = self._pending[:min(matches)]
+            self._pending = ""
+            self.stopped = True
+            return output
+        
+        # Hold back the longest tail that is a prefix of some stop sequence
+        hold = 0
+        for stop in self.stop_sequences + self.turn_markers:
+            for length in range(min(len(stop) - 1, len(self._pending)), hold, -1):
+                if self._pending.endswith(stop[:length]):
+                    hold = length
+                    break
+        output = self._pending[:len(self._pending) - hold]
+        self._pending = self._pending[len(output):]
+        if output.strip():
+            self._has_output = True
+        return output
+
+    def flush(self):
+        """Return any held-back text once the stream has ended without a match"""
+        output, self._pending = self._pending, ""
+        return output
+
+class RepetitionDetector:
+    """Detects degenerate loops where the output keeps repeating the same run of tokens"""
+    MAX_PERIOD = 64
+
+    def __init__(self, min_tokens):
+        self.min_tokens = min_tokens
+        self._tokens = []
+
+    def add(self, token_text):
+        """Record the next token; returns True once the tail of the output is a long enough loop"""
+        if self.min_tokens <= 0:
+            return False
+        tokens = self._tokens
+        tokens.append(token_text)
+        # Keep enough history to see three repeats of the longest period
+        if len(tokens) > max(self.min_tokens, 3 * self.MAX_PERIOD) + self.MAX_PERIOD:
+            del tokens[:self.MAX_PERIOD]
+        
+        for period in range(1, self.MAX_PERIOD + 1):
+            # The pattern must repeat at least three times, and cover min_tokens in total
+            span = max(self.min_tokens, period * 3)
+            if span > len(tokens):
+                break
+            if tokens[-1] != tokens[-1 - period]:
+                continue
+            if all(tokens[-i] == tokens[-i - period] for i in range(2, span - period + 1)):
+                return True
+        return False
@@ -0,0 +1,128 @@
+"""
+Append-only change log for the document library, used by the LLM server's
+/documents/changes endpoint so clients can sync deltas
+"""
+
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("llm-server")
+
+class DocumentChangeLog:
+    """Append-only log of document adds and deletes, so clients can sync deltas instead of the whole list.
+
+    Persisted as JSON lines: a header with the log's epoch and the sequence
+    number it starts after, then one line per change. Cursors are
+    "<epoch>:<seq>"; one from another epoch, or older than the retained
+    entries, can only be answered with a full snapshot.
+    """
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max(max_entries, 1)
+        self.entries = deque()
+        self.epoch = None
+        self.base_seq = 0
+        self.seq = 0
+        self._cond = threading.Condition()
+        self._load()
+
+    @property
+    def cursor(self):
+        return f"{self.epoch}:{self.seq}"
+
+    def _load(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                header = json.loads(f.readline())
+                self.epoch = str(header["epoch"])
+                self.base_seq = self.seq = int(header["base_seq"])
+                torn = False
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from an interrupted write; everything before it is intact
+                        torn = True
+                        break
+                    self.entries.append(entry)
+                    self.seq = entry["seq"]
+            if torn:
+                # Drop the fragment now, or the next append would land on the same line
+                self._rewrite()
+            return
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logger.warning(f"Document change log unreadable, starting a new one: {str(e)}")
+        
+        # A new epoch invalidates every cursor handed out before, forcing clients to resync
+        self.epoch = uuid.uuid4().hex[:8]
+        self.base_seq = self.seq = 0
+        self.entries.clear()
+        self._rewrite()
+
+    def _rewrite(self):
+        """Write the retained entries to a fresh file and swap it in atomically"""
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps({"epoch": self.epoch, "base_seq": self.base_seq}) + "\n")
+                for entry in self.entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Failed to write document change log: {str(e)}")
+
+    def append(self, op, doc_id, document=None):
+        """Record an "add" or "delete" and wake any waiting long-polls"""
+        with self._cond:
+            self.seq += 1
+            entry = {"seq": self.seq, "op": op, "id": doc_id, "at": int(time.time())}
+            if document is not None:
+                entry["document"] = document
+            self.entries.append(entry)
+            
+            if len(self.entries) > 2 * self.max_entries:
+                # Compact: drop the oldest entries; cursors older than them now get a snapshot
+                while len(self.entries) > self.max_entries:
+                    self.entries.popleft()
+                self.base_seq = self.entries[0]["seq"] - 1
+                self._rewrite()
+            else:
+                try:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry) + "\n")
+                except OSError as e:
+                    logger.error(f"Failed to append to document change log: {str(e)}")
+            self._cond.notify_all()
+
+    def changes_since(self, cursor, wait=0):
+        """Return (changes, cursor) for everything after cursor, waiting up to `wait` seconds for one.
+
+        Changes are collapsed to the latest one per document. changes is None
+        when the cursor can't be served and the client needs a full snapshot.
+        Raises ValueError for a malformed cursor.
+        """
+        epoch, _, seq = cursor.partition(":")
+        since = int(seq)
+        with self._cond:
+            if wait > 0 and epoch == self.epoch and since == self.seq:
+                self._cond.wait_for(lambda: self.seq != since, timeout=wait)
+            if epoch != self.epoch or not self.base_seq <= since <= self.seq:
+                return None, self.cursor
+            
+            latest = {}
+            for entry in reversed(self.entries):
+                if entry["seq"] <= since:
+                    break
+                latest.setdefault(entry["id"], entry)
+            changes = [
+                {key: entry[key] for key in ("op", "id", "document") if key in entry}
+                for entry in sorted(latest.values(), key=lambda e: e["seq"])
+            ]
+            return changes, self.cursor
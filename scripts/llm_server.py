@@ -9,25 +9,32 @@ import sys
 import time
 import json
 import logging
+import logging.handlers
 import traceback
 import uuid
 import shutil
+import queue
+import random
+import atexit
+import threading
+import itertools
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
 from pathlib import Path
 import argparse
 from typing import List, Dict, Any, Optional
 from werkzeug.utils import secure_filename
+from document_changes import DocumentChangeLog
+from completion_filters import StopSequenceFilter, RepetitionDetector
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
 logger = logging.getLogger("llm-server")
+# Per-request summaries go through a child logger; RequestTrace samples them
+request_logger = logging.getLogger("llm-server.requests")
 
 # Try to import required packages, provide helpful error if missing
 try:
-    from flask import Flask, request, jsonify, Response, stream_with_context, send_file
+    from flask import Flask, Blueprint, request, jsonify, Response, stream_with_context, send_file
     from flask_cors import CORS
     from llama_cpp import Llama
 except ImportError:
@@ -46,8 +53,10 @@ DEFAULT_DEEPSEEK2_MODEL = os.path.join(DEFAULT_MODEL_DIR, "DeepSeek-R1-Distill-L
 
 # Document storage configuration
 DOCUMENTS_DIR = os.path.join(HOME_DIR, "baun-documents")
-os.makedirs(DOCUMENTS_DIR, exist_ok=True)
 ALLOWED_EXTENSIONS = {'pdf', 'docx', 'xlsx', 'pptx', 'txt', 'csv', 'md', 'json', 'html', 'jpg', 'jpeg', 'png', 'gif'}
+# Server bookkeeping files live in the documents directory as dotfiles, which uploads can never be named
+CHANGE_LOG_FILENAME = ".changes.jsonl"
+MAX_CHANGES_WAIT = 30  # seconds a /documents/changes long-poll may block
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Run a local LLM server for Baun AI Tutor")
@@ -57,65 +66,107 @@ parser.add_argument("--model", type=str, default="phi3", choices=["phi3", "phi3-
 parser.add_argument("--model-path", type=str, help="Custom path to model file")
 parser.add_argument("--model-dir", type=str, default=DEFAULT_MODEL_DIR, 
                     help="Directory containing model files")
-parser.add_argument("--threads", type=int, default=4, 
-                    help="Number of threads to use (default: 4 for RPi4)")
+parser.add_argument("--threads", type=int, default=None, 
+                    help="Number of threads to use (default: 4 for RPi4, or one per core of each worker's slice with --workers)")
+parser.add_argument("--workers", type=int, default=1,
+                    help="Number of model worker processes; each gets its own llama context and a slice of the cores")
 parser.add_argument("--context-size", type=int, default= 4096,
                     help="Context size (token limit)")
 parser.add_argument("--documents-dir", type=str, default=DOCUMENTS_DIR,
                     help="Directory to store uploaded documents")
+parser.add_argument("--change-log-size", type=int, default=1000,
+                    help="Number of document changes kept for /documents/changes before older cursors need a full snapshot")
 parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+parser.add_argument("--repetition-min-tokens", type=int, default=48,
+                    help="End generation once output has looped over a repeating pattern for this many tokens (0 disables)")
+parser.add_argument("--log-sample-rate", type=float, default=0.1,
+                    help="Fraction of per-request log lines to emit (warnings are always logged)")
+parser.add_argument("--trace-buffer-size", type=int, default=200,
+                    help="Number of recent request traces kept for /debug/traces")
+parser.add_argument("--slow-request-ms", type=float, default=None,
+                    help="Requests slower than this are logged and kept in the slow-request log (off by default, "
+                         "since a full answer on a Pi routinely takes tens of seconds)")
 
-args = parser.parse_args()
-
-# Update document storage path if provided via arguments
-DOCUMENTS_DIR = args.documents_dir
-os.makedirs(DOCUMENTS_DIR, exist_ok=True)
-logger.info(f"Document storage directory: {DOCUMENTS_DIR}")
-
-# Set up model paths
-MODEL_DIRECTORY = args.model_dir
-os.makedirs(MODEL_DIRECTORY, exist_ok=True)
-
-# Determine which model to use
-if args.model_path:
-    MODEL_PATH = args.model_path
-    MODEL_NAME = args.model
-elif args.model == "phi3":
-    MODEL_PATH = DEFAULT_PHI3_MODEL
-    MODEL_NAME = "phi3"
-elif args.model == "phi3-2":
-    MODEL_PATH = DEFAULT_PHI3_2_MODEL
-    MODEL_NAME = "phi3-2"
-elif args.model == "deepseek2":
-    MODEL_PATH = DEFAULT_DEEPSEEK2_MODEL
-    MODEL_NAME = "deepseek2"
-else:
-    MODEL_PATH = DEFAULT_DEEPSEEK_MODEL
-    MODEL_NAME = "deepseek"
-
-# Configure logging
-if args.debug:
-    logger.setLevel(logging.DEBUG)
-
-logger.info(f"Using model: {MODEL_NAME}")
-logger.info(f"Model path: {MODEL_PATH}")
-
-# Check if model file exists
-if not os.path.exists(MODEL_PATH):
-    logger.error(f"Model file not found at {MODEL_PATH}")
-    logger.error("Please download the model file and place it in the models directory")
-    logger.error("Available models:")
-    logger.error("1. Phi-3 models: https://huggingface.co/microsoft/phi-3")
-    logger.error("2. DeepSeek Coder: https://huggingface.co/TheBloke/deepseek-coder-6.7B-instruct-GGUF")
-    logger.error("3. DeepSeek R1: https://huggingface.co/SandLogicTechnologies/DeepSeek-R1-Distill-Llama-8B-GGUF")
-    sys.exit(1)
+# Runtime configuration, filled in by configure(). Nothing in this module does
+# any work at import time, because spawned model workers re-import it.
+args = None
+MODEL_DIRECTORY = DEFAULT_MODEL_DIR
+MODEL_PATH = None
+MODEL_NAME = None
+# Fraction of requests whose per-request log lines are written (slow requests always are)
+LOG_SAMPLE_RATE = 1.0
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS for all routes
+# Routes are registered on a blueprint; the app itself is only created by main()
+api = Blueprint("api", __name__)
+app = None
 
-# Global model instance
+# Global model instance. With --workers > 1 this only holds the vocabulary (for
+# tokenizing) and completions are served by worker_pool.
 llm = None
+worker_pool = None
+THREADS = 4
+
+# Request tracing: recent traces live in a bounded ring buffer, slow ones are
+# also kept in a separate (smaller) slow-request log
+TRACE_BUFFER = deque(maxlen=200)
+SLOW_TRACES = deque(maxlen=50)
+_trace_lock = threading.Lock()
+
+class RequestTrace:
+    """Collects per-phase timings for a single request"""
+    def __init__(self, endpoint):
+        self.id = uuid.uuid4().hex[:12]
+        self.endpoint = endpoint
+        self.started_at = time.time()
+        self.spans = {}
+        self.attrs = {}
+        self._start = time.perf_counter()
+        self._finished = False
+        # Decided once so a request logs all of its lines or none of them
+        self.sampled = random.random() < LOG_SAMPLE_RATE
+
+    def log(self, msg, *fmt_args):
+        """Write a per-request INFO line if this request was sampled"""
+        if self.sampled:
+            request_logger.info(msg, *fmt_args)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block and add it to the named span"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Accumulate seconds onto a span (spans may be entered many times)"""
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def finish(self, status="ok"):
+        """Record the trace into the ring buffer; only the first call has any effect"""
+        if self._finished:
+            return
+        self._finished = True
+        total_ms = (time.perf_counter() - self._start) * 1000
+        record = {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "status": status,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.started_at)),
+            "total_ms": round(total_ms, 3),
+            "spans_ms": {name: round(seconds * 1000, 3) for name, seconds in self.spans.items()},
+            **self.attrs
+        }
+        slow = args.slow_request_ms is not None and total_ms >= args.slow_request_ms
+        with _trace_lock:
+            TRACE_BUFFER.append(record)
+            if slow:
+                SLOW_TRACES.append(record)
+        if slow:
+            logger.warning("Slow request %s %s: %.0f ms %s", self.id, self.endpoint, total_ms, record["spans_ms"])
+        else:
+            self.log("Request %s %s %s: %.0f ms", self.id, self.endpoint, status, total_ms)
 
 # Document handling utilities
 def allowed_file(filename):
@@ -156,6 +207,8 @@ def get_all_documents():
     """Get list of all documents"""
     documents = []
     for filename in os.listdir(DOCUMENTS_DIR):
+        if filename.startswith('.'):
+            continue
         file_path = os.path.join(DOCUMENTS_DIR, filename)
         if os.path.isfile(file_path):
             doc_info = get_document_info(filename)
@@ -166,40 +219,328 @@ def get_all_documents():
     documents.sort(key=lambda x: x.get("uploadedAt", ""), reverse=True)
     return documents
 
+change_log = None
+
+def get_model_settings(n_threads):
+    """Build Llama keyword arguments with optimized settings based on model type"""
+    # Optimize settings based on model type
+    batch_size = 512  # Default batch size
+    
+    # Adjust batch size based on model to prevent timeouts
+    if MODEL_NAME == "phi3":
+        # Phi-3 Mini is smaller, can use larger batch
+        batch_size = 512
+    elif MODEL_NAME == "phi3-2":
+        # Q8 model needs smaller batch size
+        batch_size = 256
+    elif MODEL_NAME == "deepseek" or MODEL_NAME == "deepseek2":
+        # Larger models need a much smaller batch size
+        batch_size = 64
+    
+    return {
+        "model_path": MODEL_PATH,
+        "n_ctx": args.context_size,
+        "n_threads": n_threads,
+        "n_batch": batch_size,
+        "verbose": args.debug
+    }
+
 def initialize_model():
-    """Initialize the LLM with optimized settings based on model type"""
-    global llm
+    """Initialize the LLM, or the worker pool when running with --workers"""
+    global llm, worker_pool
     
     try:
-        # Optimize settings based on model type
-        batch_size = 512  # Default batch size
-        
-        # Adjust batch size based on model to prevent timeouts
-        if MODEL_NAME == "phi3":
-            # Phi-3 Mini is smaller, can use larger batch
-            batch_size = 512
-        elif MODEL_NAME == "phi3-2":
-            # Q8 model needs smaller batch size
-            batch_size = 256
-        elif MODEL_NAME == "deepseek" or MODEL_NAME == "deepseek2":
-            # Larger models need a much smaller batch size
-            batch_size = 64
+        if args.workers > 1:
+            # The dispatcher only tokenizes, so it loads the vocabulary without weights
+            llm = Llama(model_path=MODEL_PATH, vocab_only=True, verbose=args.debug)
+            worker_pool = WorkerPool(args.workers, args.threads)
+            worker_pool.start()
+            threading.Thread(target=worker_pool.supervise, daemon=True, name="llm-worker-supervisor").start()
+            atexit.register(worker_pool.stop)
+            return
         
-        logger.info(f"Using batch size: {batch_size} for model: {MODEL_NAME}")
+        settings = get_model_settings(THREADS)
+        logger.info(f"Using batch size: {settings['n_batch']} for model: {MODEL_NAME}")
         
         # Load the model with optimized settings
-        llm = Llama(
-            model_path=MODEL_PATH,
-            n_ctx=args.context_size,
-            n_threads=args.threads,
-            n_batch=batch_size,
-            verbose=args.debug
-        )
+        llm = Llama(**settings)
         logger.info("Model loaded successfully!")
     except Exception as e:
         logger.error(f"Failed to initialize model: {str(e)}")
         sys.exit(1)
 
+def _worker_main(worker_id, cores, settings, jobs, results, cancel):
+    """Entry point of a model worker process: load a llama context and serve jobs until told to stop"""
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    
+    # Weights are mmap'd, so every worker shares the same page-cache copy of the GGUF file
+    model = Llama(**settings)
+    results.put((None, "ready", os.getpid()))
+    
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, prompt_tokens, max_tokens, temperature = job
+        if cancel.value == job_id:
+            # Still acknowledged, so the dispatcher stops counting it as in flight
+            results.put((job_id, "done", None))
+            continue
+        results.put((job_id, "started", None))
+        try:
+            for chunk in model.create_completion(
+                prompt=prompt_tokens,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True
+            ):
+                if cancel.value == job_id:
+                    break
+                results.put((job_id, "chunk", chunk))
+            results.put((job_id, "done", None))
+        except Exception as e:
+            results.put((job_id, "error", str(e)))
+
+class WorkerHandle:
+    """Dispatcher-side state of one worker process"""
+    def __init__(self, worker_id, cores, threads, restarts=0, completed=0, failed=0, cancelled=0, tokens=0):
+        self.id = worker_id
+        self.cores = cores
+        self.threads = threads
+        self.restarts = restarts
+        self.completed = completed
+        self.failed = failed
+        self.cancelled = cancelled
+        self.tokens = tokens
+        self.in_flight = 0
+        self.ready = False
+        self.active = True
+        self.stuck = False
+        self.started_at = time.time()
+        # job_id -> queue.Queue of (kind, payload) messages, or None once the requester has
+        # gone away; jobs stay here (and in flight) until the worker reports done/error
+        self.pending = {}
+        self.budgets = {}  # job_id -> seconds the job may run once started
+        self.running = None  # (job_id, deadline) of the job the worker is generating
+        self.process = None
+        self.jobs = None
+        self.results = None
+        self.cancel = None
+
+class WorkerPool:
+    """Routes completions to the least-loaded of N model worker processes and restarts any that die"""
+    RESTART_BACKOFF_MAX = 60
+    # Time a started job may take before its worker is considered stuck and restarted
+    JOB_TIMEOUT_BASE = 120
+    JOB_TIMEOUT_PER_TOKEN = 2.0
+
+    def __init__(self, size, threads=None):
+        self.size = size
+        self.threads = threads
+        self.workers = []
+        self._ctx = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+        self._stopping = False
+        self._backoff = {}
+
+    def _core_slices(self):
+        """Split the cores available to this process into one contiguous slice per worker"""
+        if hasattr(os, "sched_getaffinity"):
+            cores = sorted(os.sched_getaffinity(0))
+        else:
+            cores = list(range(os.cpu_count() or 1))
+        per_worker = max(len(cores) // self.size, 1)
+        slices = []
+        for i in range(self.size):
+            chunk = cores[i * per_worker:(i + 1) * per_worker]
+            # More workers than cores: share cores round-robin rather than leave a worker without any
+            slices.append(chunk or [cores[i % len(cores)]])
+        return slices
+
+    def start(self):
+        for worker_id, cores in enumerate(self._core_slices()):
+            self.workers.append(self._spawn(WorkerHandle(worker_id, cores, self.threads or len(cores))))
+        logger.info(f"Started {self.size} model workers")
+
+    def _spawn(self, handle):
+        handle.jobs = self._ctx.Queue()
+        handle.results = self._ctx.Queue()
+        handle.cancel = self._ctx.Value("q", 0, lock=False)
+        handle.process = self._ctx.Process(
+            target=_worker_main,
+            args=(handle.id, handle.cores, get_model_settings(handle.threads),
+                  handle.jobs, handle.results, handle.cancel),
+            name=f"llm-worker-{handle.id}",
+            daemon=True
+        )
+        handle.process.start()
+        threading.Thread(target=self._read_results, args=(handle,), daemon=True,
+                         name=f"llm-worker-{handle.id}-reader").start()
+        logger.info(f"Worker {handle.id} started (pid {handle.process.pid}, cores {handle.cores}, threads {handle.threads})")
+        return handle
+
+    def _read_results(self, handle):
+        """Forward messages from a worker's result queue to the request waiting on each job"""
+        while handle.active:
+            try:
+                job_id, kind, payload = handle.results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+            if kind == "ready":
+                handle.ready = True
+                logger.info(f"Worker {handle.id} ready (pid {payload})")
+                continue
+            with self._lock:
+                if kind == "started":
+                    budget = handle.budgets.pop(job_id, self.JOB_TIMEOUT_BASE)
+                    handle.running = (job_id, time.time() + budget)
+                    continue
+                waiter = handle.pending.get(job_id)
+                if kind == "chunk":
+                    if payload.get("choices", [{}])[0].get("text"):
+                        handle.tokens += 1
+                elif kind in ("done", "error"):
+                    handle.budgets.pop(job_id, None)
+                    if handle.running and handle.running[0] == job_id:
+                        handle.running = None
+                    if job_id in handle.pending:
+                        handle.in_flight -= 1
+                        if handle.pending.pop(job_id) is None:
+                            handle.cancelled += 1
+                        elif kind == "done":
+                            handle.completed += 1
+                        else:
+                            handle.failed += 1
+            if waiter is not None:
+                waiter.put((kind, payload))
+            elif kind == "chunk":
+                # Nobody is listening any more (client went away): stop generating
+                handle.cancel.value = job_id
+
+    def supervise(self):
+        """Restart dead workers, failing the jobs they held; runs on a background thread"""
+        while not self._stopping:
+            time.sleep(1)
+            for index, handle in enumerate(list(self.workers)):
+                self._check_stuck(handle)
+                if self._stopping or handle.process.is_alive():
+                    continue
+                backoff = self._backoff.get(handle.id, 1)
+                if time.time() - handle.started_at < backoff:
+                    continue
+                logger.error(f"Worker {handle.id} exited with code {handle.process.exitcode}, restarting")
+                handle.active = False
+                with self._lock:
+                    orphaned = [waiter for waiter in handle.pending.values() if waiter is not None]
+                    cancelled = handle.cancelled + len(handle.pending) - len(orphaned)
+                    failed = handle.failed + len(orphaned)
+                    handle.pending.clear()
+                reason = "stopped responding" if handle.stuck else "crashed"
+                for waiter in orphaned:
+                    waiter.put(("error", f"Worker {handle.id} {reason}"))
+                # A worker that dies again soon after a restart waits longer before the next one
+                uptime = time.time() - handle.started_at
+                self._backoff[handle.id] = 1 if uptime > self.RESTART_BACKOFF_MAX else min(backoff * 2, self.RESTART_BACKOFF_MAX)
+                self.workers[index] = self._spawn(WorkerHandle(
+                    handle.id, handle.cores, handle.threads, restarts=handle.restarts + 1,
+                    completed=handle.completed, failed=failed, cancelled=cancelled, tokens=handle.tokens
+                ))
+
+    def _check_stuck(self, handle):
+        """Terminate a worker whose running job has overrun its time budget; supervise() then restarts it"""
+        running = handle.running
+        if running is None or handle.stuck or time.time() < running[1]:
+            return
+        handle.stuck = True
+        logger.error(f"Worker {handle.id} exceeded the time budget for job {running[0]}, restarting")
+        handle.process.terminate()
+
+    def _pick(self):
+        """Least-loaded live worker, preferring ones that have finished loading"""
+        candidates = [w for w in self.workers if w.active and not w.stuck and w.process.is_alive()]
+        if not candidates:
+            raise RuntimeError("No model workers available")
+        return min(candidates, key=lambda w: (not w.ready, w.in_flight, w.completed))
+
+    def completion(self, prompt_tokens, max_tokens, temperature, trace=None):
+        """Stream completion chunks for a prompt from the least-loaded worker"""
+        waiter = queue.Queue()
+        with self._lock:
+            handle = self._pick()
+            job_id = next(self._job_ids)
+            handle.pending[job_id] = waiter
+            handle.budgets[job_id] = self.JOB_TIMEOUT_BASE + max_tokens * self.JOB_TIMEOUT_PER_TOKEN
+            handle.in_flight += 1
+        if trace is not None:
+            trace.attrs["worker"] = handle.id
+        handle.jobs.put((job_id, prompt_tokens, max_tokens, temperature))
+        
+        finished = False
+        try:
+            while True:
+                try:
+                    kind, payload = waiter.get(timeout=1)
+                except queue.Empty:
+                    # A live but stuck worker never answers; once it is terminated,
+                    # supervise() restarts it and fails this job
+                    self._check_stuck(handle)
+                    continue
+                if kind == "chunk":
+                    yield payload
+                elif kind == "done":
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise RuntimeError(payload)
+        finally:
+            if not finished:
+                # The job stays in flight until the worker acknowledges the cancel
+                handle.cancel.value = job_id
+                with self._lock:
+                    if job_id in handle.pending:
+                        handle.pending[job_id] = None
+
+    def stats(self):
+        with self._lock:
+            return [{
+                "id": w.id,
+                "pid": w.process.pid,
+                "alive": w.process.is_alive(),
+                "ready": w.ready,
+                "cores": w.cores,
+                "threads": w.threads,
+                "in_flight": w.in_flight,
+                "completed": w.completed,
+                "failed": w.failed,
+                "cancelled": w.cancelled,
+                "stuck": w.stuck,
+                "tokens": w.tokens,
+                "restarts": w.restarts,
+                "uptime": round(time.time() - w.started_at, 1)
+            } for w in self.workers]
+
+    def stop(self):
+        self._stopping = True
+        for handle in self.workers:
+            handle.active = False
+            try:
+                handle.jobs.put(None)
+            except (OSError, ValueError):
+                pass
+        for handle in self.workers:
+            handle.process.join(timeout=5)
+            if handle.process.is_alive():
+                handle.process.terminate()
+
+# Turn markers used by format_prompt; if the model starts writing one after its
+# answer it is inventing the next turn of the conversation, so generation stops there
+PROMPT_STOP_SEQUENCES = ["\nUser:", "\nBaun:", "\nCurrent question:"]
+
 def format_prompt(messages: List[Dict[str, str]]) -> str:
     """Format messages into a prompt that prevents the model from fabricating dialog"""
     formatted_prompt = ""
@@ -255,6 +596,86 @@ def format_prompt(messages: List[Dict[str, str]]) -> str:
     
     return formatted_prompt
 
+def stream_completion(trace, prompt_tokens, max_tokens, temperature):
+    """Stream completion chunks from the model, attributing time to prefill and decode spans"""
+    if worker_pool is not None:
+        chunks = worker_pool.completion(prompt_tokens, max_tokens, temperature, trace)
+    else:
+        chunks = iter(llm.create_completion(
+            prompt=prompt_tokens,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        ))
+    first = True
+    count = 0
+    try:
+        while True:
+            # Only time spent inside the model counts; the caller's work between chunks is excluded
+            start = time.perf_counter()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                trace.add("decode", time.perf_counter() - start)
+                break
+            trace.add("prefill" if first else "decode", time.perf_counter() - start)
+            first = False
+            # llama_cpp ends the stream with an empty chunk that only carries finish_reason
+            if chunk.get("choices", [{}])[0].get("text"):
+                count += 1
+                trace.attrs["completion_tokens"] = count
+            yield chunk
+    finally:
+        # Stops generation (and frees the worker) when the caller stops early
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+def parse_stop_sequences(value) -> List[str]:
+    """Normalize an OpenAI-style `stop` field (string or list of strings)"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = [value]
+    if not isinstance(value, list):
+        raise ValueError("stop must be a string or a list of strings")
+    return [stop for stop in value if isinstance(stop, str) and stop]
+
+def filtered_completion(trace, prompt_tokens, max_tokens, temperature, stop_sequences, turn_markers=()):
+    """Stream (text, finish_reason) pairs, ending early on a stop sequence or a repetition loop.
+
+    finish_reason is None for every pair except the last one.
+    """
+    stop_filter = StopSequenceFilter(stop_sequences, turn_markers)
+    repetition = RepetitionDetector(args.repetition_min_tokens)
+    finish_reason = "stop"
+    stop_cause = "eos"
+    
+    for chunk in stream_completion(trace, prompt_tokens, max_tokens, temperature):
+        choice = chunk.get("choices", [{}])[0]
+        text = choice.get("text", "")
+        if choice.get("finish_reason") == "length":
+            finish_reason, stop_cause = "length", "length"
+        
+        output = stop_filter.feed(text)
+        if output:
+            yield output, None
+        if stop_filter.stopped:
+            stop_cause = "stop_sequence"
+            break
+        if text and repetition.add(text):
+            stop_cause = "repetition"
+            break
+    else:
+        output = stop_filter.flush()
+        if output:
+            yield output, None
+    
+    if stop_cause in ("stop_sequence", "repetition"):
+        finish_reason = "stop"
+    trace.attrs["finish_reason"] = finish_reason
+    trace.attrs["stop_cause"] = stop_cause
+    yield "", finish_reason
+
 # Exception handling decorator
 def handle_exceptions(f):
     def wrapper(*args, **kwargs):
@@ -272,7 +693,7 @@ def handle_exceptions(f):
     wrapper.__name__ = f.__name__
     return wrapper
 
-@app.route("/", methods=["GET"])
+@api.route("/", methods=["GET"])
 @handle_exceptions
 def root():
     """Root endpoint with server information"""
@@ -289,16 +710,20 @@ def root():
             "POST /documents/upload": "Upload a document",
             "GET /documents/{id}": "Download a document",
             "DELETE /documents/{id}": "Delete a document",
-            "GET /documents/search": "Search documents"
+            "GET /documents/search": "Search documents",
+            "GET /documents/changes": "Document changes since a cursor (?since=<cursor>&wait=<seconds>)",
+            "GET /debug/traces": "Recent per-request phase timings (?slow=1 for slow requests only)",
+            "GET /workers": "Model worker pool statistics"
         },
         "model_info": {
             "path": MODEL_PATH,
             "context_size": args.context_size,
-            "threads": args.threads
+            "threads": THREADS if worker_pool is None else None,
+            "workers": args.workers
         }
     })
 
-@app.route("/health", methods=["GET"])
+@api.route("/health", methods=["GET"])
 @handle_exceptions
 def health_check():
     """Health check endpoint"""
@@ -306,20 +731,31 @@ def health_check():
         "status": "ok", 
         "model": MODEL_NAME,
         "context_size": args.context_size,
-        "threads": args.threads
+        "threads": THREADS if worker_pool is None else None,
+        "workers": args.workers,
+        "workers_ready": sum(1 for w in worker_pool.stats() if w["ready"]) if worker_pool else 1
     })
 
-@app.route("/v1/chat/completions", methods=["POST"])
+@api.route("/workers", methods=["GET"])
+@handle_exceptions
+def list_workers():
+    """Model worker pool statistics endpoint"""
+    if worker_pool is None:
+        return jsonify({"mode": "single", "threads": THREADS, "workers": []})
+    return jsonify({"mode": "pool", "workers": worker_pool.stats()})
+
+@api.route("/v1/chat/completions", methods=["POST"])
 @handle_exceptions
 def chat_completions():
     """OpenAI-compatible chat completions endpoint"""
+    trace = RequestTrace("/v1/chat/completions")
     try:
-        data = request.get_json(force=True, silent=True)
+        with trace.span("parse"):
+            data = request.get_json(force=True, silent=True)
         if not data:
-            logger.error(f"Invalid JSON or no data in request: {request.data.decode('utf-8', errors='ignore')}")
+            logger.error(f"Invalid JSON or no data in request: {request.data.decode('utf-8', errors='ignore')[:200]}")
+            trace.finish("bad_request")
             return jsonify({"error": "Invalid JSON"}), 400
-            
-        logger.info(f"Request received: {json.dumps(data)[:200]}...")
         
         messages = data.get("messages", [])
         temperature = float(data.get("temperature", 0.7))
@@ -327,56 +763,62 @@ def chat_completions():
         stream = bool(data.get("stream", False))
         
         if not messages or not isinstance(messages, list):
+            trace.finish("bad_request")
             return jsonify({"error": "Invalid or missing messages array"}), 400
-            
-        # Format the prompt
-        prompt = format_prompt(messages)
-        logger.debug(f"Formatted prompt: {prompt}")
-        logger.info(f"Prompt: {prompt}")
+        
+        try:
+            stop_sequences = parse_stop_sequences(data.get("stop"))
+        except ValueError as e:
+            trace.finish("bad_request")
+            return jsonify({"error": str(e)}), 400
+        
+        trace.log("Request %s received: %d messages, max_tokens=%d, stream=%s",
+                  trace.id, len(messages), max_tokens, stream)
+        
+        # Format and tokenize the prompt once; the token list is passed straight to the model
+        with trace.span("format_prompt"):
+            prompt = format_prompt(messages)
+        logger.debug("Formatted prompt: %s", prompt)
+        with trace.span("tokenize"):
+            prompt_tokens = llm.tokenize(prompt.encode("utf-8"), special=True)
+        trace.attrs["prompt_tokens"] = len(prompt_tokens)
         
         # Handle streaming response
         if stream:
             def generate():
                 completion_id = f"chatcmpl-{int(time.time())}"
+                status = "error"
                 
-                # Start generation with streaming
-                for chunk in llm.create_completion(
-                    prompt=prompt,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    stream=True
-                ):
-                    content = chunk.get("choices", [{}])[0].get("text", "")
+                try:
+                    # Start generation with streaming
+                    for content, finish_reason in filtered_completion(
+                        trace, prompt_tokens, max_tokens, temperature, stop_sequences, PROMPT_STOP_SEQUENCES
+                    ):
+                        # Format in OpenAI compatible format; the last chunk carries only the finish reason
+                        start = time.perf_counter()
+                        data = {
+                            "id": completion_id,
+                            "object": "chat.completion.chunk",
+                            "created": int(time.time()),
+                            "model": MODEL_NAME,
+                            "choices": [{
+                                "index": 0,
+                                "delta": {"content": content} if finish_reason is None else {},
+                                "finish_reason": finish_reason
+                            }]
+                        }
+                        
+                        # Time spent suspended in the yield is the server flushing the chunk
+                        yield f"data: {json.dumps(data)}\n\n"
+                        trace.add("serialize", time.perf_counter() - start)
                     
-                    # Format in OpenAI compatible format
-                    data = {
-                        "id": completion_id,
-                        "object": "chat.completion.chunk",
-                        "created": int(time.time()),
-                        "model": MODEL_NAME,
-                        "choices": [{
-                            "index": 0,
-                            "delta": {"content": content},
-                            "finish_reason": None
-                        }]
-                    }
-                    
-                    yield f"data: {json.dumps(data)}\n\n"
-                
-                # Send the final "DONE" message
-                done_data = {
-                    "id": completion_id,
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": MODEL_NAME,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }]
-                }
-                yield f"data: {json.dumps(done_data)}\n\n"
-                yield "data: [DONE]\n\n"
+                    yield "data: [DONE]\n\n"
+                    status = "ok"
+                except GeneratorExit:
+                    status = "disconnected"
+                    raise
+                finally:
+                    trace.finish(status)
                 
             return Response(
                 stream_with_context(generate()),
@@ -384,48 +826,46 @@ def chat_completions():
             )
         else:
             # Non-streaming response
-            logger.info(f"Generating completion for prompt (length: {len(prompt)})")
-            
             try:
-                completion = llm.create_completion(
-                    prompt=prompt,
-                    max_tokens=max_tokens,
-                    temperature=temperature,
-                    stream=False
-                )
-                
-                # Extract the generated text
-                logger.debug(f"Raw completion: {completion}")
-                generated_text = completion.get("choices", [{}])[0].get("text", "")
+                parts = []
+                for text, finish_reason in filtered_completion(
+                    trace, prompt_tokens, max_tokens, temperature, stop_sequences, PROMPT_STOP_SEQUENCES
+                ):
+                    parts.append(text)
+                generated_text = "".join(parts)
+                completion_tokens = trace.attrs.get("completion_tokens", 0)
                 
-                # Return in OpenAI-compatible format
-                response = {
-                    "id": f"chatcmpl-{int(time.time())}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": MODEL_NAME,
-                    "choices": [{
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": generated_text
-                        },
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": len(prompt),
-                        "completion_tokens": len(generated_text),
-                        "total_tokens": len(prompt) + len(generated_text)
+                with trace.span("serialize"):
+                    # Return in OpenAI-compatible format
+                    response = {
+                        "id": f"chatcmpl-{int(time.time())}",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": MODEL_NAME,
+                        "choices": [{
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": generated_text
+                            },
+                            "finish_reason": finish_reason
+                        }],
+                        "usage": {
+                            "prompt_tokens": len(prompt_tokens),
+                            "completion_tokens": completion_tokens,
+                            "total_tokens": len(prompt_tokens) + completion_tokens
+                        }
                     }
-                }
-                
-                logger.info(f"Generated response (length: {len(generated_text)})")
-                logger.debug(f"Response JSON: {json.dumps(response)[:200]}...")
+                    result = jsonify(response)
                 
-                return jsonify(response)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Response JSON: %.200s...", result.get_data(as_text=True))
+                trace.finish()
+                return result
             except Exception as e:
                 logger.error(f"Error generating completion: {str(e)}")
                 logger.error(traceback.format_exc())
+                trace.finish("error")
                 return jsonify({
                     "error": f"Failed to generate response: {str(e)}",
                     "details": traceback.format_exc()
@@ -434,18 +874,22 @@ def chat_completions():
     except Exception as e:
         logger.error(f"Error in chat_completions: {str(e)}")
         logger.error(traceback.format_exc())
+        trace.finish("error")
         return jsonify({
             "error": f"Failed to generate response: {str(e)}",
             "details": traceback.format_exc()
         }), 500
 
-@app.route("/generate", methods=["POST"])
+@api.route("/generate", methods=["POST"])
 @handle_exceptions
 def generate():
     """Simple text generation endpoint"""
+    trace = RequestTrace("/generate")
     try:
-        data = request.get_json(force=True, silent=True)
+        with trace.span("parse"):
+            data = request.get_json(force=True, silent=True)
         if not data:
+            trace.finish("bad_request")
             return jsonify({"error": "Invalid JSON"}), 400
             
         prompt = data.get("prompt")
@@ -453,27 +897,41 @@ def generate():
         max_tokens = int(data.get("max_tokens", 1000))
         
         if not prompt:
+            trace.finish("bad_request")
             return jsonify({"error": "Missing prompt"}), 400
+        
+        try:
+            stop_sequences = parse_stop_sequences(data.get("stop"))
+        except ValueError as e:
+            trace.finish("bad_request")
+            return jsonify({"error": str(e)}), 400
             
         # Generate text
-        completion = llm.create_completion(
-            prompt=prompt,
-            max_tokens=max_tokens,
-            temperature=temperature
-        )
+        with trace.span("tokenize"):
+            prompt_tokens = llm.tokenize(prompt.encode("utf-8"), special=True)
+        trace.attrs["prompt_tokens"] = len(prompt_tokens)
         
-        output = completion.get("choices", [{}])[0].get("text", "")
+        parts = []
+        for text, finish_reason in filtered_completion(
+            trace, prompt_tokens, max_tokens, temperature, stop_sequences
+        ):
+            parts.append(text)
         
-        return jsonify({
-            "output": output
-        })
+        with trace.span("serialize"):
+            result = jsonify({
+                "output": "".join(parts),
+                "finish_reason": finish_reason
+            })
+        trace.finish()
+        return result
         
     except Exception as e:
         logger.error(f"Error in generation: {str(e)}")
+        trace.finish("error")
         return jsonify({"error": "Generation failed", "details": str(e)}), 500
 
 # Document API endpoints
-@app.route("/documents", methods=["GET"])
+@api.route("/documents", methods=["GET"])
 @handle_exceptions
 def list_documents():
     """List all documents endpoint"""
@@ -484,7 +942,7 @@ def list_documents():
         logger.error(f"Error listing documents: {str(e)}")
         return jsonify({"error": "Failed to list documents", "details": str(e)}), 500
 
-@app.route("/documents/upload", methods=["POST"])
+@api.route("/documents/upload", methods=["POST"])
 @handle_exceptions
 def upload_document():
     """Upload a document endpoint"""
@@ -509,8 +967,9 @@ def upload_document():
             file.save(file_path)
             logger.info(f"Uploaded file saved to {file_path}")
             
-            # Get document info and return it
+            # Get document info, record the change and return it
             doc_info = get_document_info(file_id)
+            change_log.append("add", file_id, doc_info)
             return jsonify(doc_info)
         else:
             return jsonify({"error": f"File type not allowed. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"}), 400
@@ -519,14 +978,14 @@ def upload_document():
         logger.error(f"Error uploading document: {str(e)}")
         return jsonify({"error": "Failed to upload document", "details": str(e)}), 500
 
-@app.route("/documents/<document_id>", methods=["GET"])
+@api.route("/documents/<document_id>", methods=["GET"])
 @handle_exceptions
 def download_document(document_id):
     """Download a document by ID endpoint"""
     try:
         file_path = os.path.join(DOCUMENTS_DIR, document_id)
         
-        if not os.path.exists(file_path):
+        if document_id.startswith('.') or not os.path.exists(file_path):
             return jsonify({"error": "Document not found"}), 404
         
         # Send the file to the client
@@ -542,18 +1001,19 @@ def download_document(document_id):
         logger.error(f"Error downloading document: {str(e)}")
         return jsonify({"error": "Failed to download document", "details": str(e)}), 500
 
-@app.route("/documents/<document_id>", methods=["DELETE"])
+@api.route("/documents/<document_id>", methods=["DELETE"])
 @handle_exceptions
 def delete_document(document_id):
     """Delete a document by ID endpoint"""
     try:
         file_path = os.path.join(DOCUMENTS_DIR, document_id)
         
-        if not os.path.exists(file_path):
+        if document_id.startswith('.') or not os.path.exists(file_path):
             return jsonify({"error": "Document not found"}), 404
         
         # Delete the file
         os.remove(file_path)
+        change_log.append("delete", document_id)
         logger.info(f"Deleted document: {document_id}")
         
         return jsonify({"success": True, "message": f"Document {document_id} deleted successfully"})
@@ -562,7 +1022,32 @@ def delete_document(document_id):
         logger.error(f"Error deleting document: {str(e)}")
         return jsonify({"error": "Failed to delete document", "details": str(e)}), 500
 
-@app.route("/documents/search", methods=["GET"])
+@api.route("/documents/changes", methods=["GET"])
+@handle_exceptions
+def document_changes():
+    """Document change feed endpoint for delta sync"""
+    try:
+        since = request.args.get('since', '')
+        wait = min(max(request.args.get('wait', 0, type=float) or 0, 0), MAX_CHANGES_WAIT)
+        
+        if since:
+            try:
+                changes, cursor = change_log.changes_since(since, wait)
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+            if changes is not None:
+                return jsonify({"cursor": cursor, "snapshot": False, "changes": changes})
+        
+        # No cursor, or one that has been compacted away: send the full list.
+        # The cursor is read first so a change made while listing is replayed, not lost.
+        cursor = change_log.cursor
+        return jsonify({"cursor": cursor, "snapshot": True, "documents": get_all_documents()})
+            
+    except Exception as e:
+        logger.error(f"Error reading document changes: {str(e)}")
+        return jsonify({"error": "Failed to read document changes", "details": str(e)}), 500
+
+@api.route("/documents/search", methods=["GET"])
 @handle_exceptions
 def search_documents():
     """Search documents endpoint"""
@@ -582,7 +1067,28 @@ def search_documents():
         logger.error(f"Error searching documents: {str(e)}")
         return jsonify({"error": "Failed to search documents", "details": str(e)}), 500
 
-@app.errorhandler(Exception)
+@api.route("/debug/traces", methods=["GET"])
+@handle_exceptions
+def debug_traces():
+    """Recent request traces, newest first"""
+    slow_only = request.args.get("slow", "").lower() in ("1", "true", "yes")
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 1:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    
+    with _trace_lock:
+        traces = list(SLOW_TRACES if slow_only else TRACE_BUFFER)
+    traces.reverse()
+    if limit is not None:
+        traces = traces[:limit]
+    
+    return jsonify({
+        "slow_request_ms": args.slow_request_ms,
+        "count": len(traces),
+        "traces": traces
+    })
+
+@api.app_errorhandler(Exception)
 def handle_error(e):
     """Global error handler to ensure we always return JSON"""
     logger.error(f"Unhandled exception: {str(e)}")
@@ -593,12 +1099,98 @@ def handle_error(e):
         "timestamp": int(time.time())
     }), 500
 
-if __name__ == "__main__":
+def setup_logging():
+    """Send log records through a queue to a background thread that writes them to stdout"""
+    log_queue = queue.SimpleQueue()
+    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, stdout_handler, respect_handler_level=True)
+    # Added directly rather than through basicConfig, which would give the queue
+    # handler its own format and prefix every line twice
+    logging.getLogger().addHandler(logging.handlers.QueueHandler(log_queue))
+    logging.getLogger().setLevel(logging.INFO)
+    listener.start()
+    atexit.register(listener.stop)
+
+def configure(argv=None):
+    """Parse command line arguments and set up storage and model paths"""
+    global args, DOCUMENTS_DIR, MODEL_DIRECTORY, MODEL_PATH, MODEL_NAME, THREADS
+    global LOG_SAMPLE_RATE, TRACE_BUFFER, change_log
+    
+    args = parser.parse_args(argv)
+    
+    # Update document storage path if provided via arguments
+    DOCUMENTS_DIR = args.documents_dir
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    logger.info(f"Document storage directory: {DOCUMENTS_DIR}")
+    change_log = DocumentChangeLog(os.path.join(DOCUMENTS_DIR, CHANGE_LOG_FILENAME), args.change_log_size)
+    
+    # Set up model paths
+    MODEL_DIRECTORY = args.model_dir
+    os.makedirs(MODEL_DIRECTORY, exist_ok=True)
+    
+    # Determine which model to use
+    if args.model_path:
+        MODEL_PATH = args.model_path
+        MODEL_NAME = args.model
+    elif args.model == "phi3":
+        MODEL_PATH = DEFAULT_PHI3_MODEL
+        MODEL_NAME = "phi3"
+    elif args.model == "phi3-2":
+        MODEL_PATH = DEFAULT_PHI3_2_MODEL
+        MODEL_NAME = "phi3-2"
+    elif args.model == "deepseek2":
+        MODEL_PATH = DEFAULT_DEEPSEEK2_MODEL
+        MODEL_NAME = "deepseek2"
+    else:
+        MODEL_PATH = DEFAULT_DEEPSEEK_MODEL
+        MODEL_NAME = "deepseek"
+    
+    THREADS = args.threads or 4
+    TRACE_BUFFER = deque(maxlen=max(args.trace_buffer_size, 1))
+    
+    # Configure logging
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    LOG_SAMPLE_RATE = 1.0 if args.debug else args.log_sample_rate
+    
+    logger.info(f"Using model: {MODEL_NAME}")
+    logger.info(f"Model path: {MODEL_PATH}")
+    
+    # Check if model file exists
+    if not os.path.exists(MODEL_PATH):
+        logger.error(f"Model file not found at {MODEL_PATH}")
+        logger.error("Please download the model file and place it in the models directory")
+        logger.error("Available models:")
+        logger.error("1. Phi-3 models: https://huggingface.co/microsoft/phi-3")
+        logger.error("2. DeepSeek Coder: https://huggingface.co/TheBloke/deepseek-coder-6.7B-instruct-GGUF")
+        logger.error("3. DeepSeek R1: https://huggingface.co/SandLogicTechnologies/DeepSeek-R1-Distill-Llama-8B-GGUF")
+        sys.exit(1)
+
+def create_app():
+    """Create the Flask app with all API routes"""
+    flask_app = Flask(__name__)
+    CORS(flask_app)  # Enable CORS for all routes
+    flask_app.register_blueprint(api)
+    return flask_app
+
+def main():
+    """Configure and start the LLM server"""
+    global app
+    setup_logging()
+    configure()
     initialize_model()
+    app = create_app()
+    
     logger.info(f"LLM server running on http://localhost:{args.port}")
     logger.info(f"API endpoint: http://localhost:{args.port}/v1/chat/completions")
     logger.info(f"Document storage: {DOCUMENTS_DIR}")
     logger.info(f"Health check: http://localhost:{args.port}/health")
     
     # Start the Flask app with enhanced error handlin
-    app.run(host="0.0.0.0", port=args.port, debug=args.debug, threaded=True) 
+    # (the reloader would re-run this block in a second process and start a second worker pool)
+    app.run(host="0.0.0.0", port=args.port, debug=args.debug, threaded=True,
+            use_reloader=args.debug and worker_pool is None)
+
+if __name__ == "__main__":
+    main()
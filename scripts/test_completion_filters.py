@@ -0,0 +1,113 @@
+"""
+Tests for the stop-sequence and repetition filters applied to streamed completions
+Run with: python -m pytest scripts/test_completion_filters.py
+"""
+
+from completion_filters import StopSequenceFilter, RepetitionDetector
+
+
+def feed_all(stop_filter, chunks):
+    return [stop_filter.feed(chunk) for chunk in chunks]
+
+
+def test_stop_split_across_two_chunks():
+    stop_filter = StopSequenceFilter(["\nUser:"])
+
+    output = feed_all(stop_filter, ["An answer.\nUs", "er: next question"])
+
+    assert "".join(output) == "An answer."
+    assert stop_filter.stopped
+
+
+def test_stop_split_across_three_chunks_is_never_emitted():
+    stop_filter = StopSequenceFilter(["###"])
+
+    output = feed_all(stop_filter, ["done #", "#", "# trailing"])
+
+    assert output == ["done ", "", ""]
+    assert stop_filter.stopped
+
+
+def test_held_prefix_that_does_not_match_is_emitted():
+    stop_filter = StopSequenceFilter(["\nUser:"])
+
+    output = feed_all(stop_filter, ["Line one\nUs", "ually fine"])
+
+    assert output == ["Line one", "\nUsually fine"]
+    assert not stop_filter.stopped
+
+
+def test_held_prefix_is_flushed_at_end_of_stream():
+    stop_filter = StopSequenceFilter(["###"])
+
+    assert stop_filter.feed("Heading ##") == "Heading "
+    assert stop_filter.flush() == "##"
+    assert not stop_filter.stopped
+
+
+def test_overlapping_stop_strings_stop_at_earliest_match():
+    stop_filter = StopSequenceFilter(["bcd", "abc"])
+
+    assert feed_all(stop_filter, ["xa", "bcd"]) == ["x", ""]
+    assert stop_filter.stopped
+
+
+def test_self_overlapping_stop_string_split_across_chunks():
+    stop_filter = StopSequenceFilter(["aab"])
+
+    assert feed_all(stop_filter, ["xaa", "ab"]) == ["x", "a"]
+    assert stop_filter.stopped
+
+
+def test_period_64_loop_detected_at_192_tokens():
+    detector = RepetitionDetector(48)
+    tokens = [f"t{i % 64}" for i in range(400)]
+
+    detected_at = next(i for i, token in enumerate(tokens) if detector.add(token))
+
+    assert detected_at + 1 == 192
+
+
+def test_short_loop_detected_once_min_tokens_covered():
+    detector = RepetitionDetector(48)
+    tokens = [" I", " am", " a", " bot", "."] * 20
+
+    detected_at = next(i for i, token in enumerate(tokens) if detector.add(token))
+
+    assert detected_at + 1 == 48
+
+
+def test_varied_text_is_not_a_loop():
+    detector = RepetitionDetector(48)
+    tokens = ["The", " cat", " is", " here", "."] * 2 + ["|", "---"] * 5 + [f"w{i}" for i in range(200)]
+
+    assert not any(detector.add(token) for token in tokens)
+
+
+def test_min_tokens_zero_disables_detection():
+    detector = RepetitionDetector(0)
+
+    assert not any(detector.add("again") for _ in range(500))
+
+
+def test_leading_role_label_does_not_stop_the_reply():
+    stop_filter = StopSequenceFilter([], turn_markers=["\nUser:", "\nBaun:"])
+
+    output = feed_all(stop_filter, ["\n", "Ba", "un: Photosynthesis", " makes sugar.", "\nUser:", " thanks"])
+
+    assert "".join(output) == "\nBaun: Photosynthesis makes sugar."
+    assert stop_filter.stopped
+
+
+def test_turn_marker_after_text_in_same_chunk_stops():
+    stop_filter = StopSequenceFilter([], turn_markers=["\nUser:"])
+
+    assert stop_filter.feed("Answer.\nUser: more") == "Answer."
+    assert stop_filter.stopped
+
+
+def test_client_stop_applies_from_first_token():
+    stop_filter = StopSequenceFilter(["\nBaun:"], turn_markers=["\nUser:", "\nBaun:"])
+
+    assert feed_all(stop_filter, ["\nBa", "un: hi"]) == ["", ""]
+    assert stop_filter.stopped
@@ -0,0 +1,67 @@
+"""
+Tests for the document change log behind /documents/changes
+Run with: python -m pytest scripts/test_document_changes.py
+"""
+
+from document_changes import DocumentChangeLog
+
+
+def test_changes_collapse_to_latest_per_document(tmp_path):
+    log = DocumentChangeLog(str(tmp_path / ".changes.jsonl"), 100)
+    cursor = log.cursor
+    log.append("add", "a", {"id": "a"})
+    log.append("add", "b", {"id": "b"})
+    log.append("delete", "a")
+
+    changes, new_cursor = log.changes_since(cursor)
+
+    assert changes == [
+        {"op": "add", "id": "b", "document": {"id": "b"}},
+        {"op": "delete", "id": "a"},
+    ]
+    assert new_cursor == log.cursor
+
+
+def test_compacted_or_foreign_cursor_needs_snapshot(tmp_path):
+    log = DocumentChangeLog(str(tmp_path / ".changes.jsonl"), 2)
+    cursor = log.cursor
+    for doc_id in "abcde":
+        log.append("add", doc_id, {"id": doc_id})
+
+    assert log.changes_since(cursor)[0] is None
+    assert log.changes_since("other:0")[0] is None
+
+
+def test_reload_keeps_epoch_and_sequence(tmp_path):
+    path = str(tmp_path / ".changes.jsonl")
+    log = DocumentChangeLog(path, 100)
+    cursor = log.cursor
+    log.append("add", "a", {"id": "a"})
+
+    reloaded = DocumentChangeLog(path, 100)
+
+    assert reloaded.cursor == log.cursor
+    assert reloaded.changes_since(cursor)[0] == [{"op": "add", "id": "a", "document": {"id": "a"}}]
+
+
+def test_torn_line_then_append_then_reload(tmp_path):
+    path = str(tmp_path / ".changes.jsonl")
+    log = DocumentChangeLog(path, 100)
+    log.append("add", "a", {"id": "a"})
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"seq": 2, "op": "ad')
+
+    log = DocumentChangeLog(path, 100)
+    assert log.seq == 1
+    cursor = log.cursor
+    log.append("add", "b", {"id": "b"})
+    log.append("delete", "a")
+
+    reloaded = DocumentChangeLog(path, 100)
+
+    assert reloaded.seq == 3
+    assert reloaded.cursor == log.cursor
+    assert reloaded.changes_since(cursor)[0] == [
+        {"op": "add", "id": "b", "document": {"id": "b"}},
+        {"op": "delete", "id": "a"},
+    ]